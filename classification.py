@@ -1,12 +1,30 @@
 import os
-import json
+import orjson
+import math
+import argparse
 import numpy as np
 import librosa
-import parselmouth
+import pyworld
 import matplotlib.pyplot as plt
+from joblib import Parallel, delayed
+from numba import njit, prange
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy.fft import rfft
-from scipy.signal import butter, filtfilt
-from collections import Counter
+from scipy.signal import butter, sosfreqz
+from functools import lru_cache
+
+# loky (joblib's process backend) ignores multiprocessing's start method and has no public
+# joblib setting for it, so use its own setter when this joblib release still vendors it
+try:
+    from joblib.externals.loky.backend.context import set_start_method as set_loky_start_method
+except ImportError:
+    set_loky_start_method = None
+
+# Optional GPU backend for the batched spectral features
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
 
 # Thresholds 
 ENERGY_THRESHOLD = 100        # Minimum spectral energy required (filters out silence/very quiet noise)
@@ -15,156 +33,250 @@ FLATNESS_THRESHOLD = 0.4      # Maximum spectral flatness for voice (higher = mo
 VOICING_PROB_THRESHOLD = 0.25 # Minimum voicing probability (percentage of voiced frames)
 VB_RATIO_THRESHOLD = -0.35    # Minimum log voice band energy ratio (speech frequency concentration)
 
+# Segment labels indexed by the 0/1 output of classify_segments_batch
+LABELS = ("noise", "voice")
 
-# Bandpass filter
-def butter_bandpass_filter(data, lowcut=300, highcut=1500, sr=16000, order=4):
+# Per-segment features consumed by classify_features
+FEATURE_NAMES = ("total_energy", "spectral_flatness", "pitch", "voicing_prob", "voice_band_ratio")
+
+
+# Bandpass filter second-order sections, designed once per parameter set
+@lru_cache(maxsize=8)
+def butter_bandpass_sos(lowcut=300, highcut=1500, sr=16000, order=4):
     nyquist = 0.5 * sr
     low = lowcut / nyquist
     high = highcut / nyquist
-    b, a = butter(order, [low, high], btype='band')
-    return filtfilt(b, a, data)
-
-# Segment audio 
-def segment_audio(filepath, sr=16000, min_partial_sec=0.2):
-    y = librosa.load(filepath, sr=sr, mono=True)[0]
+    return butter(order, [low, high], btype='band', output='sos')
+
+# Power response of the zero-phase bandpass filter sampled at the rfft bins,
+# cached per segment length since every segment shares the same weights
+@lru_cache(maxsize=8)
+def bandpass_power_response(n, sr=16000, lowcut=300, highcut=1500, order=4):
+    freqs = np.fft.rfftfreq(n, d=1/sr)
+    _, h = sosfreqz(butter_bandpass_sos(lowcut, highcut, sr, order), worN=freqs, fs=sr)
+    # Forward-backward filtering squares the magnitude response, energy squares it again
+    weight = (np.abs(h) ** 4).astype(np.float32)
+    weight.flags.writeable = False
+    return weight
+
+# Segment a mono float32 signal into a (num_segments, sr) matrix, also returning
+# how many samples of the last row are real audio (less than sr for a padded tail)
+def segment_signal(y, sr=16000, min_partial_sec=0.2):
+    y = np.asarray(y, dtype=np.float32)
     segment_length = sr
     total_segments = len(y) // segment_length
-    segments_raw = [y[i * segment_length : (i + 1) * segment_length] for i in range(total_segments)]
-    remainder = y[total_segments * segment_length:]
-    if len(remainder) > min_partial_sec * segment_length:
-        segments_raw.append(remainder)
-    return segments_raw, sr
-
-# Extract pitch and voicing probability 
-def extract_parselmouth_features(raw_segment, sr=16000):
-    snd = parselmouth.Sound(values=raw_segment, sampling_frequency=sr)
-    pitch_obj = snd.to_pitch()
-    pitches = pitch_obj.selected_array['frequency']
-    avg_pitch = np.mean(pitches[pitches > 0]) if np.any(pitches > 0) else 0
+    remainder = len(y) - total_segments * segment_length
+    last_length = segment_length
+    if remainder > min_partial_sec * segment_length:
+        # Zero-pad the partial tail so every segment shares one FFT size
+        y = np.pad(y, (0, segment_length - remainder))
+        total_segments += 1
+        last_length = remainder
+    segments_raw = y[:total_segments * segment_length].reshape(total_segments, segment_length)
+    return segments_raw, last_length, sr
+
+# Segment audio file into a (num_segments, sr) matrix
+def segment_audio(filepath, sr=16000, min_partial_sec=0.2):
+    y = librosa.load(filepath, sr=sr, mono=True, dtype=np.float32)[0]
+    return segment_signal(y, sr, min_partial_sec)
+
+# Extract pitch and voicing probability with WORLD's DIO tracker refined by StoneMask
+def extract_pitch_features(raw_segment, sr=16000):
+    x = raw_segment.astype(np.float64)
+    f0, t = pyworld.dio(x, sr, f0_floor=PITCH_RANGE[0], f0_ceil=PITCH_RANGE[1], frame_period=10.0)
+    pitches = pyworld.stonemask(x, f0, t, sr)
     voiced_frames = pitches > 0
+    avg_pitch = np.mean(pitches[voiced_frames]) if np.any(voiced_frames) else 0
     voicing_prob = np.sum(voiced_frames) / len(pitches)
 
     return avg_pitch, voicing_prob
 
-# Extract voice band ratio 
-def voice_band_energy_ratio(raw_segment, sr):
-    # Use raw signal for total power
-    fft_raw = np.abs(rfft(raw_segment))
-    freqs = np.fft.rfftfreq(len(raw_segment), d=1/sr)
-    total_power = np.sum(fft_raw ** 2) + 1e-10
-
-    # Use bandpass-filtered signal to isolate voice band
-    filtered = butter_bandpass_filter(raw_segment)
-    fft_filtered = np.abs(rfft(filtered))
-    voice_band_power = np.sum(fft_filtered ** 2) + 1e-10
-
-    # Log-ratio for robustness
-    log_vbr = np.log10(voice_band_power) - np.log10(total_power)
-
-    return log_vbr
-
-
-# Extracts all features at once
-def extract_features(raw_segment, sr=16000):
-    
-    # Apply bandpass filter and convert to frequency domain using FFT
-    filtered = butter_bandpass_filter(raw_segment, sr=sr)
-    fft_mag = np.abs(rfft(filtered))
-    total_energy = np.sum(fft_mag ** 2)  
-
-    # Calculate spectral flatness
-    raw_fft_mag = np.abs(rfft(raw_segment))
-    geometric_mean = np.exp(np.mean(np.log(raw_fft_mag + 1e-10)))
-    arithmetic_mean = np.mean(raw_fft_mag + 1e-10)
-    spectral_flatness = geometric_mean / arithmetic_mean  
-
-    # Extract pitch and voicing information
-    pitch, voicing_prob = extract_parselmouth_features(raw_segment, sr)
-    
-    # Calculate voice band energy ratio
-    vb_ratio = voice_band_energy_ratio(raw_segment, sr)
-
+# Extract pitch and voicing probability for the selected rows (all by default) in parallel
+# worker processes; unselected rows are NaN and a zero-padded last row is tracked without
+# its padding so the zeros don't count as unvoiced frames
+def extract_pitch_batch(mat, sr=16000, last_length=None, selected=None):
+    n_segments = len(mat)
+    rows = np.arange(n_segments) if selected is None else np.flatnonzero(selected)
+    segments = [mat[i, :last_length] if i == n_segments - 1 else mat[i] for i in rows]
+    results = Parallel(n_jobs=os.cpu_count(), prefer='processes', batch_size=8)(
+        delayed(extract_pitch_features)(segment, sr) for segment in segments
+    )
+    pitch_info = np.full((n_segments, 2), np.nan)
+    pitch_info[rows] = np.array(results, dtype=np.float64).reshape(-1, 2)
+    return pitch_info
+
+# Bandpass energy, spectral flatness and log voice band ratio of each row of an rfft
+# spectrum, fused into a single pass over the bins (rows are processed in parallel)
+@njit(parallel=True, fastmath=True, cache=True)
+def _spectral_stats(spectrum, band_weight):
+    n_segments, n_bins = spectrum.shape
+    total_energy = np.empty(n_segments, dtype=np.float32)
+    flatness = np.empty(n_segments, dtype=np.float32)
+    vb_ratio = np.empty(n_segments, dtype=np.float32)
+    for i in prange(n_segments):
+        band_sum = 0.0
+        power_sum = 0.0
+        log_sum = 0.0
+        mag_sum = 0.0
+        for k in range(n_bins):
+            z = spectrum[i, k]
+            power = z.real * z.real + z.imag * z.imag
+            mag = math.sqrt(power) + 1e-10
+            band_sum += power * band_weight[k]
+            power_sum += power
+            log_sum += math.log(mag)
+            mag_sum += mag
+        total_energy[i] = band_sum
+        flatness[i] = math.exp(log_sum / n_bins) / (mag_sum / n_bins)
+        vb_ratio[i] = math.log10(band_sum + 1e-10) - math.log10(power_sum + 1e-10)
+    return total_energy, flatness, vb_ratio
+
+# Same statistics as _spectral_stats computed on the GPU with CuPy; the segment matrix
+# is transferred once and only the per-segment results are copied back
+def _spectral_stats_gpu(mat, band_weight):
+    spectrum = cp.fft.rfft(cp.asarray(mat), axis=1)
+    power = spectrum.real ** 2 + spectrum.imag ** 2
+    mag = cp.sqrt(power) + np.float32(1e-10)
+    total_energy = power @ cp.asarray(band_weight)
+    flatness = cp.exp(cp.mean(cp.log(mag), axis=1)) / cp.mean(mag, axis=1)
+    vb_ratio = cp.log10(total_energy + np.float32(1e-10)) - cp.log10(cp.sum(power, axis=1) + np.float32(1e-10))
+    return total_energy.get(), flatness.get(), vb_ratio.get()
+
+# Extracts the cheap spectral features for a (num_segments, segment_length) matrix whose
+# last row may hold only last_length real samples followed by zero padding
+def extract_spectral_features(mat, sr=16000, use_gpu=False, last_length=None):
+    # Stay in float32 throughout; the float64 conversion for WORLD happens per segment
+    mat = np.asarray(mat, dtype=np.float32)
+    band_weight = bandpass_power_response(mat.shape[1], sr)
+
+    # Convert to frequency domain once using FFT (float32 input gives a complex64 spectrum),
+    # then get bandpass energy via the filter's power response on the raw spectrum (Parseval),
+    # spectral flatness and log voice band energy ratio
+    if use_gpu:
+        total_energy, spectral_flatness, vb_ratio = _spectral_stats_gpu(mat, band_weight)
+    else:
+        fft_raw = rfft(mat, axis=1, workers=-1)
+        total_energy, spectral_flatness, vb_ratio = _spectral_stats(fft_raw, band_weight)
+
+    # A padded row's FFT energy scales with the FFT size, so rescale it to its real length
+    if last_length is not None and len(total_energy):
+        total_energy[-1] *= last_length / mat.shape[1]
 
     return {
         "total_energy": total_energy,
         "spectral_flatness": spectral_flatness,
-        "pitch": pitch,
-        "voicing_prob": voicing_prob,
         "voice_band_ratio": vb_ratio
     }
 
+# Extracts all features at once for a (num_segments, segment_length) matrix, such as the
+# one returned by segment_signal together with its last_length
+def extract_features_batch(mat, sr=16000, use_gpu=False, last_length=None):
+    features = extract_spectral_features(mat, sr, use_gpu, last_length)
+
+    # Extract pitch and voicing information
+    pitch_info = extract_pitch_batch(mat, sr, last_length)
+    features["pitch"] = pitch_info[:, 0]
+    features["voicing_prob"] = pitch_info[:, 1]
+
+    return features
+
+# Extracts all features for a single segment of any length in the calling process
+# (a worker pool is not worth starting for one pitch track)
+def extract_features(raw_segment, sr=16000):
+    spectral = extract_spectral_features(raw_segment[np.newaxis, :], sr)
+    features = {name: values[0] for name, values in spectral.items()}
+    features["pitch"], features["voicing_prob"] = extract_pitch_features(raw_segment, sr)
+    return features
+
 # Feature smoothing 
 def smooth_feature(values, window_size=3):
-    smoothed = []
-    for i in range(len(values)):
-        window = values[max(0, i - window_size//2):min(len(values), i + window_size//2 + 1)]
-        smoothed.append(np.mean(window))
-    return smoothed
-
-# Classification scoring system
-def classify_segment(features):
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return values
+    padded = np.pad(values, window_size // 2, mode='edge')
+    return sliding_window_view(padded, window_size).mean(axis=-1)
+
+# Segments whose pitch can affect a label: every segment inside the smoothing window
+# of a segment that passes the energy check (all others are labeled noise regardless)
+def needs_pitch_features(sm_energies, window_size=3):
+    passes = np.asarray(sm_energies) >= ENERGY_THRESHOLD
+    if len(passes) == 0:
+        return passes
+    padded = np.pad(passes, window_size // 2, mode='constant')
+    return sliding_window_view(padded, window_size).any(axis=-1)
+
+# Classification scoring system for arrays of segment features, returns 1 for voice and 0 for noise
+def classify_segments_batch(features):
 
     # Stage 1: Immediate noise classification for low-energy segments
-    if features["total_energy"] < ENERGY_THRESHOLD:
-        return "noise"
+    passes_energy = features["total_energy"] >= ENERGY_THRESHOLD
 
     # Stage 2: Calculate weighted score based on other features
-    score = 0
-    if features["spectral_flatness"] < FLATNESS_THRESHOLD:
-        score += 2
-    if PITCH_RANGE[0] <= features["pitch"] <= PITCH_RANGE[1]:
-        score += 1
-    if features["voicing_prob"] > VOICING_PROB_THRESHOLD:
-        score += 1
-    if features["voice_band_ratio"] > VB_RATIO_THRESHOLD:
-        score += 1
-
-    return "voice" if score >= 4 else "noise"
-
-# Plotting features
-def plot_features(times, energies, flatnesses, pitches, voicing_probs, vb_ratios):
-    plt.figure(figsize=(14, 14))
-
-    plt.subplot(5, 1, 1)
-    plt.plot(times, energies, marker='o', label="Smoothed Energy")
-    plt.axhline(ENERGY_THRESHOLD, color='r', linestyle='--')
-    plt.ylabel("Energy")
-    plt.legend()
-
-    plt.subplot(5, 1, 2)
-    plt.plot(times, flatnesses, marker='o', label="Smoothed Flatness", color='c')
-    plt.axhline(FLATNESS_THRESHOLD, color='r', linestyle='--')
-    plt.ylabel("Flatness")
-    plt.legend()
-
-    plt.subplot(5, 1, 3)
-    plt.plot(times, pitches, marker='o', label="Smoothed Pitch", color='g')
-    plt.axhline(PITCH_RANGE[0], color='gray', linestyle='--')
-    plt.axhline(PITCH_RANGE[1], color='gray', linestyle='--')
-    plt.ylabel("Pitch (Hz)")
-    plt.legend()
-
-    plt.subplot(5, 1, 4)
-    plt.plot(times, voicing_probs, marker='o', label="Smoothed Voicing Prob", color='orange')
-    plt.axhline(VOICING_PROB_THRESHOLD, color='gray', linestyle='--')
-    plt.ylabel("Voicing Prob")
-    plt.legend()
-
-    plt.subplot(5, 1, 5)
-    plt.plot(times, vb_ratios, marker='o', label="Smoothed Voice Band Ratio", color='brown')
-    plt.axhline(VB_RATIO_THRESHOLD, color='gray', linestyle='--')
-    plt.ylabel("VBR")
-    plt.xlabel("Time (s)")
-    plt.legend()
-
-    plt.tight_layout()
-    plt.show()
+    score = (
+        2 * (features["spectral_flatness"] < FLATNESS_THRESHOLD)
+        + ((PITCH_RANGE[0] <= features["pitch"]) & (features["pitch"] <= PITCH_RANGE[1]))
+        + (features["voicing_prob"] > VOICING_PROB_THRESHOLD)
+        + (features["voice_band_ratio"] > VB_RATIO_THRESHOLD)
+    )
+
+    return (passes_energy & (score >= 4)).astype(int)
+
+# Smooth arrays of per-segment features and classify every segment (1 voice, 0 noise)
+def classify_features(features):
+    smoothed = {name: smooth_feature(features[name]) for name in FEATURE_NAMES}
+    return classify_segments_batch(smoothed)
+
+# Classification scoring system for a single segment
+def classify_segment(features):
+    batch = {name: np.atleast_1d(value) for name, value in features.items()}
+    return LABELS[classify_segments_batch(batch)[0]]
+
+# Plotting features (shows the figure, or saves it when save_path is given)
+def plot_features(times, energies, flatnesses, pitches, voicing_probs, vb_ratios, save_path=None):
+    fig, axes = plt.subplots(5, 1, figsize=(14, 14), sharex=True)
+
+    # Draw at most ~200 markers per line so long recordings stay cheap to render
+    line_style = dict(marker='o', markevery=max(1, len(times) // 200), markersize=3, lw=0.8)
+
+    axes[0].plot(times, energies, **line_style, label="Smoothed Energy")
+    axes[0].axhline(ENERGY_THRESHOLD, color='r', linestyle='--')
+    axes[0].set_ylabel("Energy")
+    axes[0].legend()
+
+    axes[1].plot(times, flatnesses, **line_style, label="Smoothed Flatness", color='c')
+    axes[1].axhline(FLATNESS_THRESHOLD, color='r', linestyle='--')
+    axes[1].set_ylabel("Flatness")
+    axes[1].legend()
+
+    axes[2].plot(times, pitches, **line_style, label="Smoothed Pitch", color='g')
+    axes[2].axhline(PITCH_RANGE[0], color='gray', linestyle='--')
+    axes[2].axhline(PITCH_RANGE[1], color='gray', linestyle='--')
+    axes[2].set_ylabel("Pitch (Hz)")
+    axes[2].legend()
+
+    axes[3].plot(times, voicing_probs, **line_style, label="Smoothed Voicing Prob", color='orange')
+    axes[3].axhline(VOICING_PROB_THRESHOLD, color='gray', linestyle='--')
+    axes[3].set_ylabel("Voicing Prob")
+    axes[3].legend()
+
+    axes[4].plot(times, vb_ratios, **line_style, label="Smoothed Voice Band Ratio", color='brown')
+    axes[4].axhline(VB_RATIO_THRESHOLD, color='gray', linestyle='--')
+    axes[4].set_ylabel("VBR")
+    axes[4].set_xlabel("Time (s)")
+    axes[4].legend()
+
+    fig.tight_layout()
+    if save_path is None:
+        plt.show()
+    else:
+        fig.savefig(save_path, dpi=90, bbox_inches='tight')
+        plt.close(fig)
 
 # Export results 
-def export_results(labels):
-    results = [{"start_time": i, "end_time": i + 1, "label": labels[i]} for i in range(len(labels))]
-    with open("results.json", "w") as f:
-        json.dump(results, f, indent=2)
+def export_results(labels, out_path="results.json"):
+    results = [{"start_time": i, "end_time": i + 1, "label": label} for i, label in enumerate(labels)]
+    with open(out_path, "wb") as f:
+        f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
 
 # Debug print in terminal
 def print_segment_debug_info(labels, energies, flatnesses, pitches, voicing_probs, vb_ratios):
@@ -190,6 +302,19 @@ def print_segment_debug_info(labels, energies, flatnesses, pitches, voicing_prob
         print("-" * 40)
 
 if __name__ == "__main__":
+    # Start the loky pitch workers used by extract_pitch_batch with spawn on every platform
+    # (Windows only supports spawn); record.py tracks pitch in-process and starts no pool
+    if set_loky_start_method is not None:
+        set_loky_start_method("spawn", force=True)
+
+    parser = argparse.ArgumentParser(description="Rule based voice vs noise classification")
+    parser.add_argument("--gpu", action="store_true", help="compute spectral features on the GPU with CuPy")
+    args = parser.parse_args()
+
+    use_gpu = args.gpu and cp is not None
+    if args.gpu and not use_gpu:
+        print("CuPy is not installed, falling back to CPU feature extraction")
+
     recordings_dir = "recordings/noisy_testset_wav"
     wav_files = [f for f in os.listdir(recordings_dir) if f.endswith(".wav")]
 
@@ -205,55 +330,51 @@ if __name__ == "__main__":
         print(f"\nProcessing: {filename}")
 
         # Segment audio
-        segments_raw, sr = segment_audio(filepath)
-
-        # Feature extraction
-        energies, flatnesses, pitches, voicing_probs, vb_ratios = [], [], [], [], []
-        for segment in segments_raw:
-            features = extract_features(segment, sr)
-            energies.append(features["total_energy"])
-            flatnesses.append(features["spectral_flatness"])
-            pitches.append(features["pitch"])
-            voicing_probs.append(features["voicing_prob"])
-            vb_ratios.append(features["voice_band_ratio"])
-
-        # Smooth features
+        segments_raw, last_length, sr = segment_audio(filepath)
+
+        # Spectral feature extraction (all segments in one batched FFT)
+        spectral = extract_spectral_features(segments_raw, sr, use_gpu, last_length)
+        energies = spectral["total_energy"]
+        flatnesses = spectral["spectral_flatness"]
+        vb_ratios = spectral["voice_band_ratio"]
+
+        # Pitch extraction only where the smoothed energy check can pass (NaN elsewhere)
         sm_energies = smooth_feature(energies)
-        sm_flatnesses = smooth_feature(flatnesses)
-        sm_pitches = smooth_feature(pitches)
-        sm_voicing_probs = smooth_feature(voicing_probs)
-        sm_vb_ratios = smooth_feature(vb_ratios)
-
-        # Segment-level classification
-        segment_labels = []
-        for i in range(len(sm_energies)):
-            smoothed_features = {
-                "total_energy": sm_energies[i],
-                "spectral_flatness": sm_flatnesses[i],
-                "pitch": sm_pitches[i],
-                "voicing_prob": sm_voicing_probs[i],
-                "voice_band_ratio": sm_vb_ratios[i]
-            }
-            label = classify_segment(smoothed_features)
-            segment_labels.append(label)
-
-        # Majority vote to classify full file
-        label_counts = Counter(segment_labels)
-        majority_label = label_counts.most_common(1)[0][0]
+        needs_pitch = needs_pitch_features(sm_energies)
+        pitch_info = extract_pitch_batch(segments_raw, sr, last_length, needs_pitch)
+        pitches = pitch_info[:, 0]
+        voicing_probs = pitch_info[:, 1]
+
+        # Smooth features and run segment-level classification
+        label_ids = classify_features({
+            "total_energy": energies,
+            "spectral_flatness": flatnesses,
+            "pitch": pitches,
+            "voicing_prob": voicing_probs,
+            "voice_band_ratio": vb_ratios
+        })
+
+        # Majority vote to classify full file (labels are binary, so a single count suffices)
+        voice_count = int(np.count_nonzero(label_ids))
+        noise_count = len(label_ids) - voice_count
+        if voice_count == noise_count:
+            # Ties go to the label seen first, as with Counter.most_common (empty files are noise)
+            majority_label = LABELS[label_ids[0]] if len(label_ids) else "noise"
+        else:
+            majority_label = "voice" if voice_count > noise_count else "noise"
 
         if majority_label == "voice":
             file_voice_count += 1
         else:
             file_noise_count += 1
 
-        print(f"  → File classification: {majority_label.upper()} ({label_counts['voice']} voice, {label_counts['noise']} noise)")
+        print(f"  → File classification: {majority_label.upper()} ({voice_count} voice, {noise_count} noise)")
 
         # Optionally export individual segment results
         base_name = os.path.splitext(filename)[0]
+        segment_labels = [LABELS[label_id] for label_id in label_ids]
         out_json = os.path.join("results", f"results_{base_name}.json")
-        results = [{"start_time": i, "end_time": i + 1, "label": segment_labels[i]} for i in range(len(segment_labels))]
-        with open(out_json, "w") as f:
-            json.dump(results, f, indent=2)
+        export_results(segment_labels, out_json)
         print(f"  → Segment results exported to {out_json}")
 
     # Final file-level summary
@@ -1,25 +1,73 @@
 import sounddevice as sd
-from scipy.io.wavfile import write
+import soundfile as sf
+import numpy as np
+import math
 import os
+import queue
+import threading
+from classification import FEATURE_NAMES, LABELS, classify_features, extract_features
 
-def record_audio(duration_sec=60, samplerate=16000):
+# Convert recorded int16 samples to the float32 [-1, 1) range librosa.load would produce
+def int16_to_float32(audio):
+    return audio.astype(np.float32) * np.float32(1.0 / 32768.0)
+
+def record_audio(duration_sec=60, samplerate=16000, save=False, min_partial_sec=0.2):
     print(f"Recording for {duration_sec} seconds at {samplerate} Hz...")
 
-    # Record audio
-    audio = sd.rec(int(duration_sec * samplerate), samplerate=samplerate, channels=1, dtype='int16')
-    sd.wait()
+    total_frames = int(duration_sec * samplerate)
+    total_chunks = math.ceil(total_frames / samplerate)
+    chunks = queue.Queue()
+    recorded = []
+    chunk_features = []
+    done = threading.Event()
+    chunks_received = 0
+
+    # Stream callback runs on the PortAudio thread, receives exactly one second per block
+    # and hands it to the main thread
+    def callback(indata, frames, time, status):
+        nonlocal chunks_received
+        if status:
+            print(status)
+        remaining = total_frames - chunks_received * samplerate
+        chunks.put(indata[:remaining].copy())
+        chunks_received += 1
+        if chunks_received == total_chunks:
+            raise sd.CallbackStop
+
+    # Record audio, extracting features from each chunk while the next one is being recorded
+    with sd.InputStream(samplerate=samplerate, channels=1, dtype='int16', blocksize=samplerate,
+                        callback=callback, finished_callback=done.set):
+        while not (done.is_set() and chunks.empty()):
+            try:
+                chunk = chunks.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            recorded.append(chunk)
+            # The final chunk may be short; drop it like segment_signal drops a short tail
+            if len(chunk) > min_partial_sec * samplerate:
+                chunk_features.append(extract_features(int16_to_float32(chunk[:, 0]), samplerate))
+
+    # Smooth and classify the per-second features so the labels are ready when recording ends
+    features = {name: np.array([f[name] for f in chunk_features], dtype=np.float64) for name in FEATURE_NAMES}
+    labels = [LABELS[label_id] for label_id in classify_features(features)]
+
+    # Mono int16 samples; to skip the WAV round-trip, pass int16_to_float32(audio) to
+    # segment_signal and its matrix and last_length on to extract_features_batch
+    audio = np.concatenate(recorded)[:, 0]
 
-    # Make sure to change to local path
-    recordings_folder = r"C:/Users/mekha/Desktop/Vocadian/recordings"
-    os.makedirs(recordings_folder, exist_ok=True)  
-    filename = "recording.wav"
-    filepath = os.path.join(recordings_folder, filename)
+    if save:
+        # Make sure to change to local path
+        recordings_folder = r"C:/Users/mekha/Desktop/Vocadian/recordings"
+        os.makedirs(recordings_folder, exist_ok=True)
+        filename = "recording.wav"
+        filepath = os.path.join(recordings_folder, filename)
 
-    # Save to file
-    write(filepath, samplerate, audio)
-    print(f"✅ Saved to: {filepath}")
+        # Save to file once all chunks have been processed
+        sf.write(filepath, audio, samplerate, subtype='PCM_16')
+        print(f"✅ Saved to: {filepath}")
 
-    return filepath
+    return audio, samplerate, labels
 
 if __name__ == "__main__":
-    record_audio(duration_sec=60)
+    _, _, labels = record_audio(duration_sec=60, save=True)
+    print(f"Voice segments: {labels.count('voice')} of {len(labels)}")